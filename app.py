@@ -2,30 +2,61 @@ import os
 import sys
 import time
 import json
+import queue
 import atexit
+import errno
+import random
+import select
 import signal
 import threading
-from typing import Optional, List, Dict, Set, Tuple
+import uuid
+from collections import OrderedDict
+from typing import Callable, Optional, List, Dict, FrozenSet, Tuple
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 import serial
+import serial.rs485
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
+
+try:
+    import orjson
+    from flask.json.provider import DefaultJSONProvider
+except ImportError:  # optional: jsonify() falls back to Flask's stdlib json provider
+    orjson = None
 
 # ========= Logging (console + file) =========
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s %(levelname)s %(message)s",
-    handlers=[
-        logging.FileHandler("app.log", mode="a", encoding="utf-8"),
-        logging.StreamHandler(sys.stdout),
-    ],
-)
+# Callers only enqueue the record; a listener thread owns the file/console
+# handlers, so the serial path never waits on disk or stdout.
+_LOG_QUEUE: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+_log_fmt = logging.Formatter("%(asctime)s %(levelname)s %(message)s")
+_log_handlers = [
+    logging.FileHandler("app.log", mode="a", encoding="utf-8"),
+    logging.StreamHandler(sys.stdout),
+]
+for _h in _log_handlers:
+    _h.setFormatter(_log_fmt)
+# the QueueHandler only merges args/traceback into the message; _log_fmt does the rest
+logging.basicConfig(level=logging.INFO, format="%(message)s", handlers=[logging.handlers.QueueHandler(_LOG_QUEUE)])
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, *_log_handlers, respect_handler_level=True)
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)  # registered first, so it runs last and flushes everything
 log = logging.getLogger("ivc")
 
+_RID_SEC: Tuple[int, str] = (-1, "")  # (epoch second, its "HH:MM:SS") reused within the second
+
 def rid() -> str:
-    # simple request id like [HH:MM:SS.mmm]
-    return f"[{time.strftime('%H:%M:%S')}.{int((time.time()%1)*1000):03d}]"
+    # simple request id like [HH:MM:SS.mmm]; one clock read, so seconds and ms always agree
+    global _RID_SEC
+    t = time.time()
+    sec = int(t)
+    cached = _RID_SEC
+    if cached[0] != sec:
+        cached = _RID_SEC = (sec, time.strftime("%H:%M:%S", time.localtime(sec)))
+    return f"[{cached[1]}.{int((t - sec) * 1000):03d}]"
 
 # ========= Serial & timing config =========
 RS485_PORT = os.getenv("RS485_PORT", "/dev/ttyUSB0")
@@ -34,9 +65,18 @@ RS485_BYTESIZE = 8        # 8O1
 RS485_PARITY = "O"
 RS485_STOPBITS = 1
 RS485_TIMEOUT = float(os.getenv("RS485_TIMEOUT", "0.5"))     # per-byte timeout (s), reduced for quicker error detection
-INTER_CMD_DELAY = float(os.getenv("INTER_CMD_DELAY", "0.100")) # Increased to 100ms for RS-485 turnaround
 READ_DEADLINE_DEFAULT = float(os.getenv("RS485_READ_DEADLINE", "60.0"))
 IDLE_GAP_DEFAULT = float(os.getenv("RS485_IDLE_GAP", "1.0"))
+# upper bound a /click may request for read_deadline_s / idle_gap_s (select() rejects huge timeouts)
+READ_DEADLINE_MAX = float(os.getenv("RS485_READ_DEADLINE_MAX", "600.0"))
+RS485_LOW_LATENCY = os.getenv("RS485_LOW_LATENCY", "1") == "1"  # set ASYNC_LOW_LATENCY on the tty (Linux)
+RS485_FTDI_LATENCY_MS = int(os.getenv("RS485_FTDI_LATENCY_MS", "1"))  # FTDI latency_timer (driver default 16)
+# Let the kernel drive DE/RE (RTS) around each transmission (TIOCSRS485). Only for UARTs whose
+# driver supports it; auto-direction transceivers/USB adapters leave this off.
+RS485_KERNEL_MODE = os.getenv("RS485_KERNEL_MODE", "0") == "1"
+# Min bus quiet time before the next command (RS-485 turnaround). With kernel RS-485 mode the
+# driver switches DE/RE itself, so no software gap is needed by default; env overrides either way.
+INTER_CMD_DELAY = float(os.getenv("INTER_CMD_DELAY", "0" if RS485_KERNEL_MODE else "0.100"))
 
 # ========= Track motion params =========
 CLICK_VEL = 5000
@@ -44,7 +84,7 @@ CLICK_ACC_MS = 100
 CLICK_DEC_MS = 100
 
 # ========= Y→position (cm) table =========
-CLICK_Y_STOPS_CM = [10, 20, 30, 40, 50, 60, 70, 80, 90, 100]  # index: y-1
+CLICK_Y_STOPS_CM: Tuple[int, ...] = (10, 20, 30, 40, 50, 60, 70, 80, 90, 100)  # index: y-1
 
 # ========= AGV proxy config =========
 # per your note: base is 192.168.0.175:8080 (change via env if needed)
@@ -56,25 +96,115 @@ AGV_TARGETS = json.loads(os.getenv("AGV_TARGETS_JSON", json.dumps({
     "1": "1002", "2": "1003", "3": "1004", "4": "1005", "5": "1006", "6": "1007", "7": "1009"
 })))
 
+# Same map as a tuple indexed by x-1 (x = 1..7), resolved once; None where unmapped
+_AGV_TARGET_BY_X: Tuple[Optional[str], ...] = tuple(
+    str(AGV_TARGETS[str(i)]) if AGV_TARGETS.get(str(i)) is not None else None for i in range(1, 8)
+)
+
 # HTTP timeouts & retries
 AGV_REQ_TIMEOUT_S = float(os.getenv("AGV_REQ_TIMEOUT_S", "3.0"))  # per request
-AGV_REQ_RETRIES = int(os.getenv("AGV_REQ_RETRIES", "3"))          # send-task retries
+# Connect fails fast on a wrong/unreachable host; read keeps room for a slow reply
+AGV_CONNECT_TIMEOUT_S = float(os.getenv("AGV_CONNECT_TIMEOUT_S", "1.0"))
+AGV_READ_TIMEOUT_S = float(os.getenv("AGV_READ_TIMEOUT_S", str(AGV_REQ_TIMEOUT_S)))
+AGV_HTTP_TIMEOUT: Tuple[float, float] = (AGV_CONNECT_TIMEOUT_S, AGV_READ_TIMEOUT_S)  # requests' (connect, read)
+AGV_REQ_RETRIES = int(os.getenv("AGV_REQ_RETRIES", "3"))          # attempts per AGV request (incl. the first)
+
+# AGV status polls (/agv/status-summary, /agv/data) within this window share one
+# upstream fetch. 0 disables it.
+AGV_STATUS_CACHE_TTL_S = float(os.getenv("AGV_STATUS_CACHE_TTL_S", "0.25"))
+
+# ========= Duplicate-click coalescing =========
+# A repeat of the same (x, y) within this window replays the previous /click
+# response instead of re-sending the AGV task and track move. 0 disables it.
+CLICK_DEDUP_TTL_S = float(os.getenv("CLICK_DEDUP_TTL_S", "2.0"))
 
 CR = b"\r"
 app = Flask(__name__)
 
+if orjson is not None:
+    class OrjsonProvider(DefaultJSONProvider):
+        """jsonify()/get_json() backed by orjson's C encoder instead of the stdlib json module."""
+        _OPTS = orjson.OPT_NON_STR_KEYS
+
+        def dumps(self, obj, **kwargs) -> str:
+            return orjson.dumps(obj, default=self.default, option=self._OPTS).decode()
+
+        def loads(self, s, **kwargs):
+            return orjson.loads(s)
+
+        def response(self, *args, **kwargs):
+            obj = self._prepare_response_obj(args, kwargs)
+            body = orjson.dumps(obj, default=self.default, option=self._OPTS)
+            return self._app.response_class(body, mimetype=self.mimetype)
+
+    app.json = OrjsonProvider(app)
+
 log.info(f"[BOOT] AGV_BASE_URL = {AGV_BASE_URL}")
 
 # ========= Persistent serial state =========
+# Only ever holds an open handle: every close path (serial_close, serial_invalidate,
+# failed init) resets it to None, so `SER is not None` means "open" without probing
 SER: Optional[serial.Serial] = None
 SER_LOCK = threading.Lock()     # guards read/write to SER
+_SER_INIT_LOCK = threading.Lock()  # serializes lazy (re)open of SER
 _TRACK_LOCK = threading.Lock()  # ensures only one track job at a time
+# Raw tty errors pyserial lets through un-wrapped (in_waiting is a bare ioctl, flush() is
+# tcdrain); on a hung-up port these mean the same as SerialException
+try:
+    import termios
+    _TTY_ERRORS: Tuple[type, ...] = (OSError, termios.error)
+except ImportError: # non-POSIX
+    _TTY_ERRORS = (OSError,)
+# monotonic time the last exchange on SER finished; INTER_CMD_DELAY is measured from it
+_SER_LAST_IO = 0.0
 
 # Event to signal worker threads to stop
 _SHUTDOWN_EVENT = threading.Event()
+# Self-pipe mirroring _SHUTDOWN_EVENT for select(): becomes (and stays) readable on shutdown,
+# so a serial read blocked in select() wakes immediately. Never drained.
+_SHUTDOWN_R, _SHUTDOWN_W = os.pipe()
+os.set_blocking(_SHUTDOWN_W, False)
+
+def request_shutdown():
+    """Set _SHUTDOWN_EVENT and wake any select() waiting on the shutdown pipe."""
+    _SHUTDOWN_EVENT.set()
+    try:
+        os.write(_SHUTDOWN_W, b"x")
+    except OSError: # pipe full (already signalled) or closed
+        pass
+
+# Set while no move holds _TRACK_LOCK; lets /status/wait block instead of polling
+_TRACK_IDLE = threading.Event()
+_TRACK_IDLE.set()
+STATUS_WAIT_MAX_S = 30.0  # cap for /status/wait?timeout=
+# How long a new move waits for the previous one to release the track before
+# being reported busy; absorbs double-taps that land just as a move finishes.
+TRACK_BUSY_GRACE_S = float(os.getenv("TRACK_BUSY_GRACE_S", "0.02"))
+
+# Moves handed to the track consumer thread. /click takes _TRACK_LOCK before
+# queueing and the worker releases it, so at most one move is ever in flight.
+TRACK_Q: "queue.Queue[Tuple[int, str, float, float, str]]" = queue.Queue(maxsize=1)
 
 def track_busy() -> bool:
-    return _TRACK_LOCK.locked()
+    return _TRACK_LOCK.locked()  # held from enqueue until the serial exchange ends
+
+def _track_release():
+    # set before releasing: a /click that grabs the lock next clears it after us
+    _TRACK_IDLE.set()
+    _TRACK_LOCK.release()
+
+def set_ftdi_latency_timer(port: str, ms: int):
+    """Write the FTDI chip's USB latency timer via sysfs; a no-op for non-FTDI ports."""
+    dev = os.path.basename(os.path.realpath(port)) # follows /dev/serial/by-id/... links
+    path = f"/sys/bus/usb-serial/devices/{dev}/latency_timer"
+    if not os.path.exists(path):
+        return
+    try:
+        with open(path, "w") as f:
+            f.write(str(ms))
+        log.info(f"[BOOT] FTDI latency_timer on {dev} set to {ms} ms")
+    except OSError as e: # usually needs root or a udev rule
+        log.warning(f"[BOOT] FTDI latency_timer not set on {dev}: {e}")
 
 def open_serial_port() -> serial.Serial:
     byte_size_map = {5: serial.FIVEBITS, 6: serial.SIXBITS, 7: serial.SEVENBITS, 8: serial.EIGHTBITS}
@@ -91,25 +221,57 @@ def open_serial_port() -> serial.Serial:
         write_timeout=RS485_TIMEOUT,
         rtscts=False, dsrdtr=False, xonxoff=False # Typically false for RS-485
     )
+    if RS485_LOW_LATENCY:
+        # Like `setserial <port> low_latency`: USB-serial drivers (FTDI) then push RX
+        # data to the tty immediately instead of batching it for up to 16 ms.
+        try:
+            ser.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError) as e:
+            log.warning(f"[BOOT] low-latency mode not applied on {RS485_PORT}: {e}")
+        # some ftdi_sio versions ignore ASYNC_LOW_LATENCY; the sysfs timer is authoritative
+        set_ftdi_latency_timer(RS485_PORT, RS485_FTDI_LATENCY_MS)
+    if RS485_KERNEL_MODE:
+        # RTS high while sending, low for receive (INTER_CMD_DELAY defaults to 0 in this mode)
+        try:
+            ser.rs485_mode = serial.rs485.RS485Settings(rts_level_for_tx=True, rts_level_for_rx=False)
+        except Exception as e: # driver/platform without TIOCSRS485 support
+            log.warning(f"[BOOT] kernel RS-485 mode not applied on {RS485_PORT}: {e}")
+            try:
+                ser.rs485_mode = None # don't re-apply the rejected setting on later reconfigures
+            except Exception:
+                pass
     return ser
 
+# open() errors that retrying within serial_init cannot fix
+_SERIAL_OPEN_PERMANENT: FrozenSet[int] = frozenset({errno.ENOENT, errno.EACCES, errno.EPERM})
+SERIAL_OPEN_BACKOFF_MAX_S = 5.0
+
 def serial_init(retries: int = 3, delay_s: float = 1.0):
     """Open the RS-485 port, with retries, and keep it for the whole app lifetime."""
     global SER
-    if SER and getattr(SER, "is_open", False):
+    if SER is not None:
         log.info("[BOOT] Serial port already open.")
         return SER
 
     for i in range(retries):
         try:
             log.info(f"[BOOT] Attempt {i+1}/{retries} to open serial {RS485_PORT} {RS485_BAUD}bps 8{RS485_PARITY}1 timeout={RS485_TIMEOUT}s")
-            SER = open_serial_port()
+            SER = open_serial_port()  # pyserial flushes the input queue on open
             log.info("[BOOT] Serial opened successfully.")
             return SER
         except serial.SerialException as e:
-            log.warning(f"[BOOT] Serial open failed: {e}. Retrying in {delay_s}s...")
             SER = None # Ensure SER is None if opening fails
-            time.sleep(delay_s)
+            if e.errno in _SERIAL_OPEN_PERMANENT:
+                # waiting won't fix a missing port or bad permissions; the next
+                # move retries via serial_get_or_raise anyway
+                log.error(f"[BOOT] Serial open failed: {e}. Not retrying.")
+                return None
+            if i + 1 < retries:
+                wait_s = min(delay_s * (2 ** i), SERIAL_OPEN_BACKOFF_MAX_S) # 1x, 2x, 4x ... capped
+                log.warning(f"[BOOT] Serial open failed: {e}. Retrying in {wait_s:.1f}s...")
+                time.sleep(wait_s)
+            else:
+                log.warning(f"[BOOT] Serial open failed: {e}.")
         except Exception as e:
             log.error(f"[BOOT] Unexpected error during serial init: {e}")
             SER = None
@@ -121,7 +283,7 @@ def serial_close():
     """Close the port at shutdown."""
     global SER
     # Signal workers to stop gracefully before trying to close serial
-    _SHUTDOWN_EVENT.set() 
+    request_shutdown()
     log.info("[SHUTDOWN] Signaled worker threads to stop.")
 
     with SER_LOCK: # Acquire lock before accessing SER to prevent race conditions during shutdown
@@ -138,38 +300,71 @@ def serial_close():
 def serial_get_or_raise() -> serial.Serial:
     """Return open serial or raise if not available. Attempts re-init if closed."""
     global SER
-    if SER and getattr(SER, "is_open", False):
-        return SER
-    
-    log.warning("[SERIAL] Serial port not open, attempting re-initialization.")
-    SER = serial_init(retries=1, delay_s=0.5) # Try to re-init once
-    if SER and getattr(SER, "is_open", False):
-        return SER
+    ser = SER  # fast path: one global read, no is_open probe (see SER)
+    if ser is not None:
+        return ser
+
+    # double-checked: only one thread re-opens, the others reuse its handle
+    with _SER_INIT_LOCK:
+        if SER is not None:
+            return SER
+        log.warning("[SERIAL] Serial port not open, attempting re-initialization.")
+        SER = serial_init(retries=1, delay_s=0.5) # Try to re-init once
+        if SER is not None:
+            return SER
     raise serial.SerialException("Serial port is not available or could not be re-opened.")
 
+def serial_invalidate(req_id: str = ""):
+    """Drop a failed handle so the next serial_get_or_raise() re-opens it. Caller holds SER_LOCK."""
+    global SER
+    ser, SER = SER, None
+    if ser is None:
+        return
+    log.warning(f"{req_id} [SERIAL] invalidating handle after I/O error, will re-open on next use")
+    try:
+        ser.close()
+    except Exception as e:
+        log.warning(f"{req_id} [SERIAL] close after error failed: {e}")
+
 # ========= TRACK helpers =========
+# Fixed receive buffer reused by every read_messages_until() call; the tty is read
+# straight into it (os.readv), so no bytes object is allocated per chunk. Only
+# touched with SER_LOCK held.
+_RX_BUF = bytearray(4096)
+_RX_VIEW = memoryview(_RX_BUF)
+
 def make_command(head: str, *args: int) -> bytes:
-    head = head.strip().upper()
-    parts = [head] + [str(int(v)) for v in args]
-    return ",".join(parts).encode("ascii") + CR
+    # formatted straight into bytes: no str parts, join or encode per argument
+    fmt = b"%b" + b",%d" * len(args) + CR
+    return fmt % (head.strip().upper().encode("ascii"), *(int(v) for v in args))
 
 def read_messages_until(
     ser: serial.Serial,
     overall_deadline_s: float,
     idle_gap_s: Optional[float] = None,
-    req_id: str = ""
-) -> Optional[List[str]]:
-    lines: List[str] = []
-    buf = bytearray()
-    start_time = time.monotonic()
+    req_id: str = "",
+    on_line: Optional[Callable[[Dict[str, str]], None]] = None
+) -> Optional[List[Dict[str, str]]]:
+    """Read CR-terminated controller lines, classified as they arrive via _RX_CODES."""
+    lines: List[Dict[str, str]] = []
+    buf, view = _RX_BUF, _RX_VIEW # shared, so not reentrant: callers hold SER_LOCK
+    fill = 0 # buf[:fill] holds the partial line carried over between reads
+    # loop-invariant globals/attributes bound to locals once (LOAD_FAST in the loop)
+    is_shutdown, monotonic, select_, shutdown_r = _SHUTDOWN_EVENT.is_set, time.monotonic, select.select, _SHUTDOWN_R
+    rx_codes, find, cr = _RX_CODES, buf.find, CR
+    start_time = monotonic()
     last_rx_time = start_time
     got_any_data = False
+    try:
+        fd: Optional[int] = ser.fileno()
+    except (AttributeError, OSError): # backends without a selectable fd (e.g. Windows)
+        fd = None
 
     while True:
-        now = time.monotonic()
+        now = monotonic()
 
         # Check for shutdown signal
-        if _SHUTDOWN_EVENT.is_set():
+        if is_shutdown():
             log.info(f"{req_id} [TRACK] read: Shutdown event received, stopping read.")
             return None
 
@@ -183,35 +378,70 @@ def read_messages_until(
             log.info(f"{req_id} [TRACK] read: idle gap ({idle_gap_s:.2f}s) reached (stopping read).")
             break
 
-        try:
-            # Use a smaller timeout for serial.read() if a shutdown event is possible
-            # This allows the loop to frequently check _SHUTDOWN_EVENT
-            read_timeout = min(RS485_TIMEOUT, 0.1) # Check every 100ms
-            b = ser.read(1) # This uses the per-byte timeout (RS485_TIMEOUT)
-        except serial.SerialTimeoutException:
-            # This can happen if no byte arrives within read_timeout
-            # If we haven't received anything yet, it's a "no data" issue
-            if not got_any_data:
-                log.debug(f"{req_id} [TRACK] read: No initial byte within {read_timeout:.1f}s.")
-            continue # Continue checking deadlines
-
-        if b:
-            got_any_data = True
-            buf.extend(b)
-            last_rx_time = now # Update last received time
-            
-            if b == CR:
-                line = bytes(buf[:-1]).decode("ascii", errors="replace").strip()
-                buf = bytearray() # Reset buffer for next line
-                if line:
-                    lines.append(line)
-                    log.info(f"{req_id} [TRACK] <- {line}")
-                    if line in TERMINAL_OK or line in ERROR_CODES:
-                        log.info(f"{req_id} [TRACK] read: Terminal message '{line}' received.")
-                        break
-        # If no byte received (b is empty), the loop will continue and check deadlines.
-        # This occurs if the per-byte timeout (RS485_TIMEOUT) expires.
-    
+        if fill == len(buf):
+            log.warning(f"{req_id} [TRACK] read: {fill} bytes without CR, discarding them.")
+            fill = 0
+
+        if fd is not None:
+            # Sleep in select() until bytes arrive, shutdown is requested or the nearest
+            # deadline passes, then take whatever the tty has buffered with a single readv().
+            wait_s = overall_deadline_s - (now - start_time)
+            if got_any_data and idle_gap_s is not None:
+                wait_s = min(wait_s, idle_gap_s - (now - last_rx_time))
+            ready, _, _ = select_([fd, shutdown_r], [], [], max(0.0, wait_s))
+            if shutdown_r in ready:
+                log.info(f"{req_id} [TRACK] read: Shutdown event received, stopping read.")
+                return None
+            if not ready:
+                continue # nothing yet; re-check deadlines
+            try:
+                n = os.readv(fd, [view[fill:]])
+            except BlockingIOError:
+                continue # spurious wakeup (port is opened non-blocking)
+            except OSError as e: # e.g. EIO after hang-up; wrapped like pyserial's own read()
+                raise serial.SerialException(f"read failed: {e}") from e
+            if not n:
+                raise serial.SerialException("device reports readiness to read but returned no data "
+                                             "(device disconnected or multiple access on port?)")
+        else:
+            # Pull everything the driver already buffered in one call; when nothing is
+            # pending, block for a single byte (bounded by the port timeout, RS485_TIMEOUT)
+            # so the shutdown/deadline checks above still run regularly.
+            chunk = ser.read(min(ser.in_waiting or 1, len(buf) - fill))
+            n = len(chunk)
+            if not n:
+                continue # Timeout expired with no data; re-check deadlines
+            buf[fill:fill + n] = chunk
+
+        got_any_data = True
+        last_rx_time = monotonic()
+        end = fill + n
+
+        # Split complete CR-terminated lines out of buf[:end]; keep any partial tail
+        terminal = False
+        start = 0
+        while (i := find(cr, start, end)) != -1:
+            raw = bytes(view[start:i]).strip()
+            start = i + 1
+            if raw:
+                # one lookup both classifies the line and tells whether it ends the read
+                entry, terminal = rx_codes.get(raw) or (None, False)
+                if entry is None:
+                    line = raw.decode("ascii", errors="replace")
+                    entry = {"code": line, "type": "info", "text": line}
+                lines.append(entry)
+                log.info("%s [TRACK] <- %s", req_id, entry["code"]) # lazy: formatted only if emitted
+                if on_line is not None:
+                    on_line(entry)
+                if terminal:
+                    log.info("%s [TRACK] read: Terminal message '%s' received.", req_id, entry["code"])
+                    break
+        if terminal:
+            break
+        fill = end - start
+        if start and fill:
+            buf[:fill] = buf[start:end] # move the partial tail to the front (same size, no realloc)
+
     if not lines:
         log.warning(f"{req_id} [TRACK] No complete lines received within deadline or before idle gap.")
         return None
@@ -223,41 +453,61 @@ def send_and_receive_multi(
     cmd_bytes: bytes,
     overall_deadline_s: float,
     idle_gap_s: Optional[float],
-    req_id: str = ""
-) -> Optional[List[str]]:
-    ser.reset_input_buffer()
-    ser.reset_output_buffer()
-    log.info(f"{req_id} [TRACK] -> {cmd_bytes!r}")
-    
+    req_id: str = "",
+    on_line: Optional[Callable[[Dict[str, str]], None]] = None
+) -> Optional[List[Dict[str, str]]]:
+    global _SER_LAST_IO
+    # RS-485 turnaround: keep the bus quiet for INTER_CMD_DELAY after the previous
+    # exchange. Only the remainder is slept, so spaced-out clicks pay nothing.
+    gap = INTER_CMD_DELAY - (time.monotonic() - _SER_LAST_IO)
+    if gap > 0:
+        if _SHUTDOWN_EVENT.wait(gap):
+            log.info(f"{req_id} [TRACK] Shutdown event received during INTER_CMD_DELAY, stopping.")
+            return None
+
+    # Late lines from the previous exchange (e.g. DONE after an OK ack, or a reply
+    # that missed its deadline) must not be read as the reply to this command:
+    # drain them with one read instead of a tcflush. The output side needs no
+    # reset, every write below is followed by tcdrain().
+    try:
+        stale_n = ser.in_waiting
+        if stale_n:
+            stale = ser.read(stale_n)
+            log.debug("%s [TRACK] discarded %d stale bytes: %r", req_id, len(stale), stale)
+    except serial.SerialException: # an OSError subclass; already the right type
+        raise
+    except _TTY_ERRORS as e: # in_waiting is a bare ioctl: EIO once the tty hung up
+        raise serial.SerialException(f"in_waiting failed: {e}") from e
+
+    log.info("%s [TRACK] -> %r", req_id, cmd_bytes)
+    # a failed write propagates as SerialException; the caller invalidates the port
     try:
         ser.write(cmd_bytes)
-        ser.flush()
-    except serial.SerialException as e:
-        log.error(f"{req_id} [TRACK] Write failed: {e}")
-        return None
-    
-    # Check shutdown event before sleeping
-    if _SHUTDOWN_EVENT.is_set():
-        log.info(f"{req_id} [TRACK] Shutdown event received before INTER_CMD_DELAY, stopping.")
-        return None
-
-    time.sleep(INTER_CMD_DELAY) # Crucial delay for RS-485 turnaround
-    
-    return read_messages_until(ser, overall_deadline_s=overall_deadline_s, idle_gap_s=idle_gap, req_id=req_id)
+        ser.flush() # tcdrain(): returns once the command has left the UART
+    except serial.SerialException:
+        raise
+    except _TTY_ERRORS as e: # tcdrain on a hung-up tty raises termios.error
+        raise serial.SerialException(f"write failed: {e}") from e
+
+    # No post-write sleep: replies queue in the tty buffer and the read loop
+    # below waits for them.
+    try:
+        return read_messages_until(ser, overall_deadline_s=overall_deadline_s, idle_gap_s=idle_gap_s,
+                                   req_id=req_id, on_line=on_line)
+    finally:
+        _SER_LAST_IO = time.monotonic()
 
 def cm_to_units(cm: float) -> int:
     return int(round(cm * 1000.0))  # cm → 0.01mm
 
-def classify_messages(lines: List[str]) -> List[Dict[str, str]]:
-    out: List[Dict[str, str]] = []
-    for raw in lines:
-        key = raw.strip()
-        meta = MSG_CLASS.get(key)
-        if meta is None:
-            out.append({"code": key, "type": "info", "text": key})
-        else:
-            out.append({"code": key, "type": meta["type"], "text": meta["text"]})
-    return out
+# Position (units) for each Y, resolved once; index: y-1
+_Y_TO_UNITS: Tuple[int, ...] = tuple(cm_to_units(cm) for cm in CLICK_Y_STOPS_CM)
+# Full ABS command bytes for each Y (motion params are constants too)
+_ABS_CMDS: Tuple[bytes, ...] = tuple(
+    make_command("ABS", u, CLICK_VEL, CLICK_ACC_MS, CLICK_DEC_MS) for u in _Y_TO_UNITS
+)
+# Same commands as text (no trailing CR) for job records
+_ABS_CMD_STRS: Tuple[str, ...] = tuple(c.decode("ascii").rstrip() for c in _ABS_CMDS)
 
 # ========= Message classes =========
 MSG_CLASS: Dict[str, Dict[str, str]] = {
@@ -271,53 +521,139 @@ MSG_CLASS: Dict[str, Dict[str, str]] = {
     "NOT_HOME_OK":  {"type": "error",   "text": "Not at HOME (reported as OK)."},
     "OK":           {"type": "success", "text": "Command acknowledged/OK."} # Added for general acknowledgements
 }
-ERROR_CODES: Set[str] = {k for k, v in MSG_CLASS.items() if v["type"] == "error"}
-TERMINAL_OK: Set[str] = {"DONE", "HOME_OK", "RESTART_OK", "OK"} # Added "OK" as a potential terminal success
+ERROR_CODES: FrozenSet[str] = frozenset(k for k, v in MSG_CLASS.items() if v["type"] == "error")
+TERMINAL_OK: FrozenSet[str] = frozenset({"DONE", "HOME_OK", "RESTART_OK", "OK"}) # Added "OK" as a potential terminal success
+_TERMINAL_ANY: FrozenSet[str] = TERMINAL_OK | ERROR_CODES  # any code that ends a read
+# Prebuilt classified entries for the known codes (shared between jobs; treat as read-only)
+_CLASSIFIED: Dict[str, Dict[str, str]] = {
+    k: {"code": k, "type": v["type"], "text": v["text"]} for k, v in MSG_CLASS.items()
+}
+# Same, keyed by the raw received bytes, with whether the code ends a read
+_RX_CODES: Dict[bytes, Tuple[Dict[str, str], bool]] = {
+    k.encode("ascii"): (v, k in _TERMINAL_ANY) for k, v in _CLASSIFIED.items()
+}
 
 # ========= AGV helpers =========
+class _JitteredRetry(Retry):
+    """Exponential backoff with full jitter: before retry n (1, 2, ...) sleep uniformly in
+    [0, min(BACKOFF_CAP_S, backoff_factor * 2**(n-1))], so the first retry already waits.
+
+    Retry-After on 503 still takes precedence (urllib3 checks it before backoff).
+    Computed here rather than via urllib3's backoff_max/get_backoff_time, which differ
+    between urllib3 1.26 and 2.x.
+    """
+    BACKOFF_CAP_S = 4.0
+
+    def get_backoff_time(self) -> float:
+        n = len(self.history) # attempts that failed so far, i.e. the retry about to run
+        if n < 1 or self.backoff_factor <= 0:
+            return 0.0
+        return random.uniform(0.0, min(self.BACKOFF_CAP_S, self.backoff_factor * (2 ** (n - 1))))
+
+def _make_agv_session() -> requests.Session:
+    """Shared session: keep-alive connection pool plus urllib3 retry/backoff for all AGV calls."""
+    retry = _JitteredRetry(
+        total=max(AGV_REQ_RETRIES - 1, 0),
+        backoff_factor=0.3,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=frozenset({"GET", "POST"}),  # send-task was always retried, keep that
+        raise_on_status=False,  # hand back the last response; callers map status codes
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+    session = requests.Session()
+    # pinned rather than left to the requests default: /agv/data arrays compress well
+    session.headers["Accept-Encoding"] = "gzip, deflate"
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+AGV_SESSION = _make_agv_session()
+
 def agv_url(path: str) -> str:
     base = AGV_BASE_URL.rstrip("/")
     if not path.startswith("/"):
         path = "/" + path
     return f"{base}{path}"
 
-def http_get(url: str, timeout: float, req_id: str = "") -> requests.Response:
-    log.info(f"{req_id} [AGV] GET {url}")
-    resp = requests.get(url, timeout=timeout)
-    log.info(f"{req_id} [AGV] <- HTTP {resp.status_code} {resp.text[:300]}")
+def agv_json(resp: requests.Response):
+    """Decode an AGV JSON body, with orjson when it is installed.
+
+    A bad body raises requests' JSONDecodeError either way, as resp.json() does.
+    """
+    if orjson is None:
+        return resp.json()
+    try:
+        return orjson.loads(resp.content)
+    except orjson.JSONDecodeError as e:
+        raise requests.exceptions.JSONDecodeError(e.msg, e.doc, e.pos) from e
+
+def http_get(url: str, timeout: Tuple[float, float], req_id: str = "") -> requests.Response:
+    log.info("%s [AGV] GET %s", req_id, url)
+    resp = AGV_SESSION.get(url, timeout=timeout)
+    if log.isEnabledFor(logging.INFO): # only the logged prefix is decoded (no charset sniffing)
+        log.info("%s [AGV] <- HTTP %s %s", req_id, resp.status_code, resp.content[:300].decode("utf-8", "replace"))
     return resp
 
-def http_post_json(url: str, payload: dict, timeout: float, req_id: str = "") -> requests.Response:
-    body = json.dumps(payload, ensure_ascii=False)
-    log.info(f"{req_id} [AGV] POST {url} body={body}")
-    resp = requests.post(url, json=payload, headers={"Content-Type": "application/json"}, timeout=timeout)
-    log.info(f"{req_id} [AGV] <- HTTP {resp.status_code} {resp.text[:300]}")
+def http_post_json(url: str, payload: dict, timeout: Tuple[float, float], req_id: str = "") -> requests.Response:
+    # encoded once and sent as-is (json= would make requests encode it again)
+    body = orjson.dumps(payload) if orjson is not None else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    if log.isEnabledFor(logging.INFO):
+        log.info("%s [AGV] POST %s body=%s", req_id, url, body[:300].decode("utf-8", "replace"))
+    resp = AGV_SESSION.post(url, data=body, headers={"Content-Type": "application/json"}, timeout=timeout)
+    if log.isEnabledFor(logging.INFO): # only the logged prefix is decoded (no charset sniffing)
+        log.info("%s [AGV] <- HTTP %s %s", req_id, resp.status_code, resp.content[:300].decode("utf-8", "replace"))
     return resp
 
-def agv_fetch_all(req_id: str = "") -> dict:
-    url = agv_url("/YIDAGV/api/agv/data")
-    resp = http_get(url, AGV_REQ_TIMEOUT_S, req_id=req_id)
+_AGV_DATA_CACHE: Tuple[float, Optional[dict]] = (0.0, None)  # (monotonic ts, payload)
+_AGV_DATA_LOCK = threading.Lock()
+
+def _agv_data_fresh() -> Optional[dict]:
+    ts, data = _AGV_DATA_CACHE
+    if data is not None and time.monotonic() - ts < AGV_STATUS_CACHE_TTL_S:
+        return data
+    return None
+
+def agv_cache_invalidate() -> None:
+    global _AGV_DATA_CACHE
+    _AGV_DATA_CACHE = (0.0, None)
+
+def _agv_fetch_data(req_id: str) -> dict:
+    global _AGV_DATA_CACHE
+    resp = http_get(agv_url("/YIDAGV/api/agv/data"), AGV_HTTP_TIMEOUT, req_id=req_id)
     resp.raise_for_status()
-    return resp.json()
+    data = agv_json(resp)
+    _AGV_DATA_CACHE = (time.monotonic(), data)
+    return data
+
+def agv_fetch_all(req_id: str = "", force: bool = False) -> dict:
+    """GET /agv/data. Concurrent pollers within AGV_STATUS_CACHE_TTL_S share one fetch.
+
+    force=True always fetches, and does so without _AGV_DATA_LOCK so /click never
+    queues behind a poller's fetch (and its retries) against a slow AGV.
+    """
+    if force:
+        return _agv_fetch_data(req_id)
+    data = _agv_data_fresh()
+    if data is not None:
+        return data
+    with _AGV_DATA_LOCK:
+        data = _agv_data_fresh()  # another poller refreshed it while we waited
+        if data is not None:
+            return data
+        return _agv_fetch_data(req_id)
 
 def agv_send_task(target: str, req_id: str = "") -> dict:
     url = agv_url("/YIDAGV/api/task/send-task")
-    last_err = None
-    for i in range(1, AGV_REQ_RETRIES + 1):
-        try:
-            resp = http_post_json(url, {"agvId": AGV_ID, "target": target}, AGV_REQ_TIMEOUT_S, req_id=req_id)
-            if resp.status_code == 200:
-                return resp.json() if resp.content else {"ok": True}
-            try:
-                data = resp.json()
-            except Exception:
-                data = {"error": resp.text}
-            raise requests.HTTPError(f"send-task HTTP {resp.status_code}: {data}")
-        except Exception as e:
-            last_err = e
-            log.warning(f"{req_id} [AGV] send-task attempt {i}/{AGV_REQ_RETRIES} failed: {e}")
-            time.sleep(min(1.0 * i, 2.0))
-    raise last_err
+    # connection errors and 502/503/504 are retried with backoff by AGV_SESSION
+    resp = http_post_json(url, {"agvId": AGV_ID, "target": target}, AGV_HTTP_TIMEOUT, req_id=req_id)
+    if resp.status_code == 200:
+        agv_cache_invalidate()  # the cached snapshot predates this task
+        return agv_json(resp) if resp.content else {"ok": True}
+    try:
+        data = agv_json(resp)
+    except Exception:
+        data = {"error": resp.content.decode("utf-8", "replace")}
+    raise requests.HTTPError(f"send-task HTTP {resp.status_code}: {data}")
 
 def agv_pick_one(agvs: list, agv_id: int) -> Optional[dict]:
     for a in agvs:
@@ -341,78 +677,243 @@ def agv_task_status(agv: dict) -> Tuple[str, Optional[str]]:
         return ("NONE", None)
     return (str(t.get("status", "NONE")).upper(), str(t.get("taskNumber")) if "taskNumber" in t else None)
 
-# ========= Track worker (background thread) =========
-def track_move_worker(y: int, req_id: str, deadline: float, idle_gap: float):
-    # only one track job at a time
-    if not _TRACK_LOCK.acquire(blocking=False): # Non-blocking acquire
-        log.warning(f"{req_id} [TRACK] Attempted to start move for y={y}, but track is already busy.")
-        return # Track is busy, exit worker early
+# ========= Click dedup cache =========
+_CLICK_CACHE: Dict[Tuple[int, int], Tuple[float, Dict[str, object]]] = {}
+_CLICK_CACHE_LOCK = threading.Lock()
+
+def click_cache_get(key: Tuple[int, int]) -> Optional[Dict[str, object]]:
+    """Return the cached /click response for key if still fresh. A different key invalidates all entries."""
+    with _CLICK_CACHE_LOCK:
+        entry = _CLICK_CACHE.get(key)
+        if entry is None:
+            _CLICK_CACHE.clear()  # new target: earlier responses describe a stale position
+            return None
+        ts, resp = entry
+        if time.monotonic() - ts >= CLICK_DEDUP_TTL_S:
+            del _CLICK_CACHE[key]
+            return None
+        # the response is cached once the move is queued; if that move has since
+        # failed or been cancelled, a repeat click must retry it, not replay "ok"
+        if track_job_status(resp.get("track_job_id")) in _TRACK_JOB_UNSUCCESSFUL:
+            del _CLICK_CACHE[key]
+            return None
+        return resp
+
+def click_cache_put(key: Tuple[int, int], resp: Dict[str, object]):
+    if CLICK_DEDUP_TTL_S <= 0:
+        return
+    with _CLICK_CACHE_LOCK:
+        _CLICK_CACHE[key] = (time.monotonic(), resp)
+
+# ========= Track job results =========
+# Recent job states for GET /track/<job_id>; oldest entries are evicted first.
+TRACK_JOBS_KEEP = 64
+_TRACK_JOBS: "OrderedDict[str, Dict[str, object]]" = OrderedDict()
+_TRACK_JOBS_LOCK = threading.Lock()
+_TRACK_JOBS_COND = threading.Condition(_TRACK_JOBS_LOCK)  # notified on every job change
+TRACK_JOB_FINAL = frozenset({"done", "failed", "busy", "cancelled"})
+_TRACK_JOB_UNSUCCESSFUL = TRACK_JOB_FINAL - {"done"}
+
+def track_job_update(job_id: str, **fields):
+    if not job_id:
+        return
+    with _TRACK_JOBS_COND:
+        job = _TRACK_JOBS.get(job_id)
+        if job is None:
+            job = _TRACK_JOBS[job_id] = {"job_id": job_id}
+            while len(_TRACK_JOBS) > TRACK_JOBS_KEEP:
+                _TRACK_JOBS.popitem(last=False)
+        job.update(fields)
+        _TRACK_JOBS_COND.notify_all()
+
+def track_job_add_line(job_id: str, entry: Dict[str, str]):
+    """Record one classified controller line as progress of a running job."""
+    if not job_id:
+        return
+    with _TRACK_JOBS_COND:
+        job = _TRACK_JOBS.get(job_id)
+        if job is not None:
+            # copy-on-write so snapshots handed out by track_job_get() never change under a reader
+            job["progress"] = job.get("progress", []) + [entry]
+            _TRACK_JOBS_COND.notify_all()
+
+def track_job_status(job_id: Optional[str]) -> Optional[str]:
+    """Current status of a job, or None if unknown/evicted."""
+    if not job_id:
+        return None
+    with _TRACK_JOBS_LOCK:
+        job = _TRACK_JOBS.get(job_id)
+        return job.get("status") if job is not None else None
+
+def track_job_get(job_id: str) -> Optional[Dict[str, object]]:
+    with _TRACK_JOBS_LOCK:
+        job = _TRACK_JOBS.get(job_id)
+        return dict(job) if job is not None else None
 
+# ========= Track worker (background thread) =========
+def track_move_worker(y: int, req_id: str, deadline: float, idle_gap: float, job_id: str = ""):
+    """Run one move. The caller must already hold _TRACK_LOCK; ownership passes to
+    this function, which releases it (via _track_release) on every path."""
+    # final job state, recorded in `finally` whichever way the worker exits
+    result: Dict[str, object] = {"status": "failed"}
+    locked = True
     try:
         # Check for shutdown signal immediately
         if _SHUTDOWN_EVENT.is_set():
             log.info(f"{req_id} [TRACK] Shutdown event received, worker not starting.")
+            result = {"status": "cancelled", "error": "shutting down"}
             return
 
         # map Y -> position
-        try:
-            cm = CLICK_Y_STOPS_CM[y - 1]
-        except IndexError:
+        if not (1 <= y <= len(_Y_TO_UNITS)):
             log.error(f"{req_id} [TRACK] invalid Y={y} (no mapping)")
+            result["error"] = f"invalid y={y}"
             return
-        pos_units = cm_to_units(cm)
-        cmd = make_command("ABS", pos_units, CLICK_VEL, CLICK_ACC_MS, CLICK_DEC_MS)
+        cm = CLICK_Y_STOPS_CM[y - 1]
+        pos_units = _Y_TO_UNITS[y - 1]
+        cmd = _ABS_CMDS[y - 1]
         log.info(f"{req_id} [TRACK] MOVE y={y} -> {cm} cm (pos={pos_units})")
+        track_job_update(job_id, status="running", cm=cm, pos=pos_units, cmd=_ABS_CMD_STRS[y - 1])
 
         # use the shared serial and guard I/O
         try:
             ser = serial_get_or_raise()
         except serial.SerialException as e:
             log.error(f"{req_id} [TRACK] serial unavailable: {e}")
+            result["error"] = f"serial unavailable: {e}"
             return
         except Exception as e:
             log.error(f"{req_id} [TRACK] unexpected error getting serial: {e}")
+            result["error"] = f"serial error: {e}"
             return
 
         with SER_LOCK:
             # Check shutdown event again before serial I/O
             if _SHUTDOWN_EVENT.is_set():
                 log.info(f"{req_id} [TRACK] Shutdown event received before serial command, worker aborting.")
+                result = {"status": "cancelled", "error": "shutting down"}
+                return
+
+            try:
+                parsed = send_and_receive_multi(ser, cmd,
+                                                overall_deadline_s=deadline,
+                                                idle_gap_s=idle_gap,
+                                                req_id=req_id,
+                                                on_line=lambda entry: track_job_add_line(job_id, entry))
+            except (serial.SerialException, *_TTY_ERRORS) as e:
+                log.error(f"{req_id} [TRACK] serial I/O failed: {e}")
+                serial_invalidate(req_id)
+                result["error"] = f"serial I/O failed: {e}"
                 return
 
-            lines = send_and_receive_multi(ser, cmd,
-                                           overall_deadline_s=deadline,
-                                           idle_gap_s=idle_gap,
-                                           req_id=req_id)
-        if lines is None:
+        # serial exchange is over: let the next move start while this one is classified/logged
+        _track_release()
+        locked = False
+
+        if parsed is None:
             # Check if shutdown caused the early exit
             if _SHUTDOWN_EVENT.is_set():
                 log.info(f"{req_id} [TRACK] Worker terminated due to shutdown event during serial communication.")
+                result = {"status": "cancelled", "error": "shutting down"}
             else:
                 log.error(f"{req_id} [TRACK] no reply within {deadline:.1f}s (or before idle gap).")
+                result["error"] = f"no reply within {deadline:.1f}s"
             return
         
-        parsed = classify_messages(lines)
         ok = all(p.get("type") != "error" for p in parsed)
-        log.info(f"{req_id} [TRACK] parsed={parsed} ok={ok}")
+        if log.isEnabledFor(logging.INFO):
+            log.info(f"{req_id} [TRACK] parsed={parsed} ok={ok}")
+        result = {"status": "done" if ok else "failed", "ok": ok, "parsed": parsed}
 
         if not ok:
             log.error(f"{req_id} [TRACK] Track command failed, received error messages: {parsed}")
 
     except Exception as e:
         log.exception(f"{req_id} [TRACK] An unhandled error occurred in track_move_worker: {e}")
+        result = {"status": "failed", "error": f"unhandled error: {e}"}
     finally:
-        _TRACK_LOCK.release() # Ensure lock is always released
+        if locked:
+            _track_release() # Ensure lock is always released
+        track_job_update(job_id, **result)
+
+def _track_consumer():
+    """Single long-lived thread that runs queued moves one at a time."""
+    while not _SHUTDOWN_EVENT.is_set():
+        try:
+            item = TRACK_Q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+        try:
+            track_move_worker(*item)
+        finally:
+            TRACK_Q.task_done()
+    log.info("[TRACK] consumer thread stopped.")
 
 # ========= Routes =========
 @app.route("/")
 def index():
     return render_template("index.html")
 
+# /status has only four possible bodies; each is encoded once, keyed by (track_busy, serial_open)
+_STATUS_BODIES: Dict[Tuple[bool, bool], bytes] = {}
+
 @app.get("/status")
 def status():
-    open_flag = bool(SER and getattr(SER, "is_open", False))
-    return jsonify({"track_busy": track_busy(), "serial_open": open_flag, "port": RS485_PORT})
+    key = (track_busy(), SER is not None)
+    body = _STATUS_BODIES.get(key)
+    if body is None:
+        body = app.json.response({"track_busy": key[0], "serial_open": key[1], "port": RS485_PORT}).get_data()
+        _STATUS_BODIES[key] = body
+    return Response(body, mimetype="application/json")
+
+@app.get("/status/wait")
+def status_wait():
+    """Long-poll variant of /status: returns once the track is idle or after ?timeout= seconds."""
+    try:
+        timeout_s = min(max(float(request.args.get("timeout", "5")), 0.0), STATUS_WAIT_MAX_S)
+    except ValueError:
+        return jsonify({"ok": False, "error": "timeout must be a number"}), 400
+    _TRACK_IDLE.wait(timeout_s)
+    return status()
+
+@app.get("/track/<job_id>")
+def track_job(job_id: str):
+    job = track_job_get(job_id)
+    if job is None:
+        return jsonify({"ok": False, "job_id": job_id, "error": "unknown job id"}), 404
+    return jsonify({"ok": True, **job})
+
+@app.get("/track/<job_id>/events")
+def track_job_events(job_id: str):
+    """Server-Sent Events: one `data:` frame per controller line as it arrives, then `event: done`."""
+    if track_job_get(job_id) is None:
+        return jsonify({"ok": False, "job_id": job_id, "error": "unknown job id"}), 404
+
+    def gen():
+        sent = 0
+        while not _SHUTDOWN_EVENT.is_set():
+            with _TRACK_JOBS_COND:
+                _TRACK_JOBS_COND.wait_for(
+                    lambda: job_id not in _TRACK_JOBS
+                    or len(_TRACK_JOBS[job_id].get("progress", ())) > sent
+                    or _TRACK_JOBS[job_id].get("status") in TRACK_JOB_FINAL,
+                    timeout=15.0)
+                job = _TRACK_JOBS.get(job_id)
+                if job is None:
+                    return # evicted from the job store
+                new = job.get("progress", [])[sent:]
+                final = dict(job) if job.get("status") in TRACK_JOB_FINAL else None
+            sent += len(new)
+            for entry in new:
+                yield f"data: {app.json.dumps(entry)}\n\n"
+            if final is not None:
+                yield f"event: done\ndata: {app.json.dumps(final)}\n\n"
+                return
+            if not new:
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(gen()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache"})
 
 # Optional: quick connectivity test
 @app.get("/agv/test")
@@ -422,8 +923,8 @@ def agv_test():
     rid_ = rid()
     try:
         log.info(f"{rid_} [AGV] TEST GET {url}")
-        resp = requests.get(url, timeout=AGV_REQ_TIMEOUT_S)
-        return jsonify({"ok": True, "status": resp.status_code, "body": resp.text[:1000], "url": url})
+        resp = requests.get(url, timeout=AGV_HTTP_TIMEOUT)
+        return jsonify({"ok": True, "status": resp.status_code, "body": resp.content[:1000].decode("utf-8", "replace"), "url": url})
     except Exception as e:
         log.error(f"{rid_} [AGV] TEST error: {e}")
         return jsonify({"ok": False, "error": str(e), "url": url}), 502
@@ -494,29 +995,37 @@ def api_agv_send_task():
         log.error(f"{rid_} [AGV] send-task error: {e}")
         return jsonify({"ok": False, "error": f"send-task failed: {e}"}), 502
 
-# ---- Main /click: AGV (sync) first, then Track (async worker) ----
-@app.post("/click")
-def click():
-    """
-    From 3D UI: {x:1..7, y:1..10}
-    Flow:
-      1) AGV: check status -> send-task (wait HTTP reply) -> stop (no polling)
-      2) Track: if not busy, start background thread to perform ABS move
-      3) Return immediately with agv_result + track_job_started/busy
-    """
-    rid_ = rid()
-    payload = request.get_json(force=True) or {}
-    x = int(payload.get("x", 0))
-    y = int(payload.get("y", 0))
-    log.info(f"{rid_} [/click] recv x={x}, y={y} from {request.remote_addr}")
+def parse_click_payload(payload) -> Tuple[int, int, float, float]:
+    """Validate a /click body into (x, y, read_deadline_s, idle_gap_s); ValueError carries the 400 message."""
+    if not isinstance(payload, dict):
+        raise ValueError("body must be a JSON object")
 
-    if not (1 <= y <= 10):
-        return jsonify({"ok": False, "error": f"invalid y={y} (expected 1..10)"}), 400
-
-    # ---- (1) AGV: check & send once (sync) ----
+    def num(key: str, default, cast):
+        v = payload.get(key, default)
+        # bool is an int subclass and None/list/dict would raise TypeError in int()/float()
+        if isinstance(v, bool) or not isinstance(v, (int, float, str)):
+            raise ValueError(f"{key} must be a number")
+        try:
+            return cast(v)
+        except (ValueError, OverflowError):
+            raise ValueError(f"{key} must be a number") from None
+
+    x = num("x", 0, int)
+    y = num("y", 0, int)
+    deadline = num("read_deadline_s", READ_DEADLINE_DEFAULT, float)
+    idle_gap = num("idle_gap_s", IDLE_GAP_DEFAULT, float)
+    if not (0 < deadline < float("inf")) or not (0 < idle_gap < float("inf")):
+        raise ValueError("read_deadline_s and idle_gap_s must be positive")
+    if deadline > READ_DEADLINE_MAX or idle_gap > READ_DEADLINE_MAX:
+        raise ValueError(f"read_deadline_s and idle_gap_s must be at most {READ_DEADLINE_MAX:g}")
+    return x, y, deadline, idle_gap
+
+# ---- Main /click: queue the Track move (consumer thread) first, then the AGV leg (sync) ----
+def _click_agv(x: int, rid_: str) -> Dict[str, object]:
+    """/click AGV leg: check status -> send-task (wait HTTP reply) -> stop (no polling)."""
     agv_result = {"ok": False, "skipped": False, "base": AGV_BASE_URL}
     try:
-        data = agv_fetch_all(req_id=rid_)
+        data = agv_fetch_all(req_id=rid_, force=True)  # busy check must not see a stale snapshot
         agvs = data if isinstance(data, list) else data.get("data", [])
         agv = agv_pick_one(agvs, AGV_ID)
         if not agv:
@@ -530,8 +1039,8 @@ def click():
             if busy_now:
                 agv_result = {"ok": False, "busy": True, "error": f"AGV {AGV_ID} busy (status={st0}, taskNumber={tn0})", "base": AGV_BASE_URL}
             else:
-                target_key = str(min(max(x, 1), 7)) # Ensure x is within 1-7 range for target mapping
-                target = AGV_TARGETS.get(target_key)
+                target_key = min(max(x, 1), 7) # Ensure x is within 1-7 range for target mapping
+                target = _AGV_TARGET_BY_X[target_key - 1]
                 if not target:
                     msg = f"no target mapped for x={x} (mapped to {target_key})"
                     log.error(f"{rid_} [AGV] {msg}")
@@ -548,50 +1057,108 @@ def click():
     except Exception as e:
         log.error(f"{rid_} [AGV] fetch data failed: {e}")
         agv_result = {"ok": False, "error": f"fetch agv data failed: {e}", "base": AGV_BASE_URL}
+    return agv_result
+
+@app.post("/click")
+def click():
+    """
+    From 3D UI: {x:1..7, y:1..10}
+    Flow:
+      1) Track: if not busy, queue the ABS move for the track consumer thread
+      2) AGV: check status -> send-task (wait HTTP reply) -> stop (no polling)
+      3) Return immediately with agv_result + track_job_started/busy + track_job_id
+         (poll GET /track/<track_job_id> for the move result)
+    """
+    rid_ = rid()
+    payload = request.get_json(force=True) or {}
+    try:
+        x, y, deadline, idle_gap = parse_click_payload(payload)
+    except ValueError as e:
+        log.warning(f"{rid_} [/click] bad payload from {request.remote_addr}: {e}")
+        return jsonify({"ok": False, "error": str(e)}), 400
+    log.info(f"{rid_} [/click] recv x={x}, y={y} from {request.remote_addr}")
 
-    # ---- (2) Track: start async worker if not busy ----
+    if not (1 <= y <= 10):
+        return jsonify({"ok": False, "error": f"invalid y={y} (expected 1..10)"}), 400
+
+    # ---- (0) Replay a fresh identical click instead of re-dispatching ----
+    cached = click_cache_get((x, y))
+    if cached is not None:
+        log.info(f"{rid_} [/click] duplicate x={x}, y={y} within {CLICK_DEDUP_TTL_S:.1f}s, returning cached response")
+        return jsonify({**cached, "cached": True})
+
+    # ---- (1) Track: queue the move first so it runs during the AGV round-trips ----
     track_started = False
+    job_id = None
     if _SHUTDOWN_EVENT.is_set(): # Don't start new workers if shutting down
         log.info(f"{rid_} [TRACK] application is shutting down, skipping new move.")
-    elif track_busy():
+    elif not _TRACK_LOCK.acquire(timeout=TRACK_BUSY_GRACE_S): # short grace absorbs back-to-back clicks
         log.info(f"{rid_} [TRACK] busy: skip starting new move")
     else:
-        deadline = float(payload.get("read_deadline_s", READ_DEADLINE_DEFAULT))
-        idle_gap = float(payload.get("idle_gap_s", IDLE_GAP_DEFAULT))
-        t = threading.Thread(target=track_move_worker, args=(y, rid_, deadline, idle_gap), daemon=True)
-        t.start()
-        track_started = True
-        log.info(f"{rid_} [TRACK] worker started for y={y}")
+        # we own the track now; the consumer's worker releases it when the move ends
+        _TRACK_IDLE.clear()
+        job_id = uuid.uuid4().hex
+        track_job_update(job_id, status="queued", x=x, y=y)
+        try:
+            TRACK_Q.put_nowait((y, rid_, deadline, idle_gap, job_id))
+            track_started = True
+            log.info(f"{rid_} [TRACK] move queued for y={y} job={job_id}")
+        except queue.Full:
+            _track_release()
+            track_job_update(job_id, status="busy", error="track busy")
+            log.info(f"{rid_} [TRACK] busy: move already queued, skip starting new move")
+
+    # ---- (2) AGV: check & send once (sync) ----
+    agv_result = _click_agv(x, rid_)
 
     # ---- (3) Return immediately ----
-    return jsonify({
+    resp = {
         "ok": agv_result.get("ok", False) and track_started, # 'ok' is true if both AGV task sent AND track job started
         "x": x, "y": y,
         "agv_result": agv_result,
         "track_job_started": track_started,
+        "track_job_id": job_id,
         "track_busy": track_busy(),
-        "serial_open": bool(SER and getattr(SER, "is_open", False))
-    })
+        "serial_open": SER is not None
+    }
+    if resp["ok"]:
+        click_cache_put((x, y), resp)
+    return jsonify(resp)
 
 # ========= Startup / Shutdown hooks =========
 atexit.register(serial_close)
 
+# started at import so it also runs under gunicorn (one worker process, no --preload)
+_TRACK_CONSUMER = threading.Thread(target=_track_consumer, name="track-consumer", daemon=True)
+_TRACK_CONSUMER.start()
+
+# Signal self-pipe: the handler only writes the signal number here (async-signal-safe,
+# takes no locks); _shutdown_watcher does the actual cleanup on a normal thread.
+_SIGNAL_R, _SIGNAL_W = os.pipe()
+os.set_blocking(_SIGNAL_W, False)
+
 def _sig_handler(signum, frame):
+    try:
+        os.write(_SIGNAL_W, bytes([signum]))
+    except OSError: # pipe full: a shutdown is already under way
+        pass
+
+def _shutdown_watcher():
+    signum = os.read(_SIGNAL_R, 1)[0]
     log.info(f"[SIGNAL] received {signum}, initiating graceful shutdown...")
-    # Signal all worker threads to stop
-    _SHUTDOWN_EVENT.set()
-    # Close serial port (also called by atexit)
+    # wakes blocked reads, then waits for SER_LOCK and closes the port (also called by atexit)
     serial_close()
-    
-    # Give a short moment for cleanup, especially if there are other threads.
-    # In a real production environment with Gunicorn, Gunicorn would manage worker processes.
-    time.sleep(1) 
-    
+    # let a move that was mid-exchange record its cancelled state
+    _TRACK_CONSUMER.join(timeout=1.0)
+
     # Use os._exit() for a forceful exit to ensure termination,
     # as sys.exit() can be caught by Flask's development server.
     log.info(f"[SIGNAL] Forcefully exiting process.")
+    _LOG_LISTENER.stop()  # os._exit() skips atexit; drain queued log records first
     os._exit(0)
 
+threading.Thread(target=_shutdown_watcher, name="shutdown-watcher", daemon=True).start()
+
 for _sig in (signal.SIGINT, signal.SIGTERM):
     try:
         signal.signal(_sig, _sig_handler)
@@ -610,6 +1177,19 @@ if __name__ == "__main__":
         # Decide here if you want to exit or let the app run without serial
         # For now, we let it run, and serial_get_or_raise will attempt re-init
     
-    log.info("[BOOT] Starting Flask application...")
-    # Make sure use_reloader is False to avoid multiple processes and cleaner shutdown
-    app.run(host="0.0.0.0", port=8000, debug=True, use_reloader=False) 
\ No newline at end of file
+    debug = os.getenv("FLASK_DEBUG") == "1"
+    try:
+        from waitress import serve  # optional production WSGI server
+    except ImportError:
+        serve = None
+
+    if serve is not None and not debug:
+        threads = int(os.getenv("WSGI_THREADS", "8"))
+        log.info(f"[BOOT] Starting waitress on :8000 with {threads} threads...")
+        serve(app, host="0.0.0.0", port=8000, threads=threads)
+    else:
+        log.info("[BOOT] Starting Flask application...")
+        # Make sure use_reloader is False to avoid multiple processes and cleaner shutdown.
+        # threaded=True keeps /status and /agv/* responsive while other requests are in flight;
+        # for production install waitress or use gunicorn (see README), debug only when FLASK_DEBUG=1.
+        app.run(host="0.0.0.0", port=8000, debug=debug, threaded=True, use_reloader=False)